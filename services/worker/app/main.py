@@ -1,33 +1,56 @@
-import json
+import asyncio
 import logging
 import os
 from typing import Dict, Any
 
+import aio_pika
 import httpx
-import pika
+import orjson
+import uvloop
 
 from azure.monitor.opentelemetry import configure_azure_monitor
 from opentelemetry import trace
 from opentelemetry.instrumentation.logging import LoggingInstrumentor
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
-from opentelemetry.propagate import extract
+from opentelemetry import propagate
 from opentelemetry.trace import SpanKind
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter as OTLPHTTPTraceExporter
+from grpc import Compression
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter as OTLPGrpcTraceExporter
 
 
-configure_azure_monitor()
+# Optional Azure Monitor export (uses APPLICATIONINSIGHTS_CONNECTION_STRING);
+# off by default so each span is serialized and exported once, via OTLP.
+if os.getenv("OTEL_USE_AZURE_MONITOR", "false").lower() == "true":
+    configure_azure_monitor()
 LoggingInstrumentor().instrument(set_logging_format=True)
 HTTPXClientInstrumentor().instrument()
 
 
 def _configure_otlp_exporter() -> None:
     try:
-        endpoint = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT", "http://apm-server:4318/v1/traces")
-        exporter = OTLPHTTPTraceExporter(endpoint=endpoint)
+        endpoint = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT", "apm-server:8200")
         provider = trace.get_tracer_provider()
-        if hasattr(provider, "add_span_processor"):
-            provider.add_span_processor(BatchSpanProcessor(exporter))
+        if not hasattr(provider, "add_span_processor"):
+            return
+        # configure_azure_monitor() may already have attached an OTLP pipeline;
+        # adding a second one would export every span twice.
+        active = getattr(provider, "_active_span_processor", None)
+        for processor in getattr(active, "_span_processors", ()):
+            if isinstance(getattr(processor, "span_exporter", None), OTLPGrpcTraceExporter):
+                logger.info("OTLP exporter already registered, skipping")
+                return
+        # gRPC rides one persistent HTTP/2 connection and gzip halves the
+        # wire size of each span batch.
+        exporter = OTLPGrpcTraceExporter(endpoint=endpoint, insecure=True, compression=Compression.Gzip)
+        provider.add_span_processor(
+            BatchSpanProcessor(
+                exporter,
+                max_queue_size=8192,
+                max_export_batch_size=1024,
+                schedule_delay_millis=int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "2000")),
+            )
+        )
         logger.info("OTLP exporter configured endpoint=%s", endpoint)
     except Exception as e:  # noqa: BLE001
         logger.exception("Failed to configure OTLP exporter: %s", e)
@@ -38,72 +61,265 @@ logger.setLevel(logging.INFO)
 tracer = trace.get_tracer(__name__)
 _configure_otlp_exporter()
 
+# Resolved once; propagate.extract() would look the propagator up in the
+# global registry on every message.
+_PROPAGATOR = propagate.get_global_textmap()
 
-def _normalize_headers(headers: Dict[str, Any] | None) -> Dict[str, str]:
-    if not headers:
-        return {}
-    normalized: Dict[str, str] = {}
-    for k, v in headers.items():
-        key = k.decode() if isinstance(k, (bytes, bytearray)) else str(k)
-        if isinstance(v, (bytes, bytearray)):
-            normalized[key] = v.decode(errors="ignore")
-        else:
-            normalized[key] = str(v)
-    return normalized
+# Compact trace-context header emitted by chat-service:
+# "<trace_id hex>-<span_id hex>". Messages from other producers fall back to
+# standard W3C extraction.
+TRACE_CTX_HEADER = "x-trace-ctx"
 
 
-def main() -> None:
-    rabbit_host = os.getenv("RABBITMQ_HOST", "localhost")
-    queue_name = os.getenv("RABBITMQ_QUEUE", "chat-jobs")
-    dotnet_url = os.getenv("DOTNET_SERVICE_URL", "http://localhost:8080")
+def _producer_link(header_value: str) -> trace.Link | None:
+    try:
+        trace_id_hex, span_id_hex = header_value.split("-", 1)
+        producer_context = trace.SpanContext(
+            trace_id=int(trace_id_hex, 16),
+            span_id=int(span_id_hex, 16),
+            is_remote=True,
+            trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED),
+        )
+    except ValueError:
+        return None
+    return trace.Link(producer_context)
 
-    logger.info("Worker connecting to RabbitMQ host=%s queue=%s", rabbit_host, queue_name)
+# How many messages may be in flight on the event loop at once; matches the
+# broker-side prefetch so the consumer stays fully occupied.
+MAX_CONCURRENCY = 256
+
+# Completed deliveries are acked in batches (multiple=True) instead of one
+# ack round-trip per message.
+ACK_BATCH_SIZE = 32
+ACK_FLUSH_INTERVAL_SEC = 0.1
+
+
+class _AckBatcher:
+    """Settles completed deliveries with one multiple-ack per batch.
 
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbit_host))
-    channel = connection.channel()
-    channel.queue_declare(queue=queue_name, durable=True)
-    channel.basic_qos(prefetch_count=10)
+    Handlers finish out of order, so only the longest contiguous run of
+    completed delivery tags is acked; a single basic_ack with multiple=True
+    covers the whole run. Tags that were already nacked are skipped but
+    still advance the watermark.
+    """
 
-    def on_message(ch, method, properties, body):  # type: ignore[no-redef]
-        headers = _normalize_headers(getattr(properties, "headers", None))
-        context = extract(headers)
+    def __init__(self, channel: aio_pika.abc.AbstractChannel) -> None:
+        self._channel = channel
+        self._messages: Dict[int, aio_pika.abc.AbstractIncomingMessage] = {}
+        self._settled: set[int] = set()
+        self._next_tag = 1
+        self._lock = asyncio.Lock()
+
+    async def done(
+        self, message: aio_pika.abc.AbstractIncomingMessage, already_settled: bool = False
+    ) -> None:
+        async with self._lock:
+            # Fence deliveries from before the last reconnect: handlers can
+            # still be in flight when the robust channel reopens, and their
+            # delivery tags would collide with same-numbered tags on the new
+            # channel, settling messages that were never processed.
+            underlay = await self._channel.get_underlay_channel()
+            if message.channel is not underlay:
+                logger.warning(
+                    "Dropping completion for pre-reconnect delivery tag=%s",
+                    message.delivery_tag,
+                )
+                return
+            tag = message.delivery_tag
+            if not already_settled:
+                self._messages[tag] = message
+            self._settled.add(tag)
+            if len(self._settled) >= ACK_BATCH_SIZE:
+                try:
+                    await self._flush()
+                except aio_pika.exceptions.ChannelInvalidStateError as exc:
+                    # State is intact; the flusher retries and reset() clears
+                    # it if the channel is really gone.
+                    logger.warning("Opportunistic batch ack failed: %s", exc)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush()
+
+    async def reset(self) -> None:
+        """Drop all pending state after the robust channel reopens.
+
+        Delivery tags restart at 1 on the new channel and everything unacked
+        is redelivered, so pre-reconnect tags and message objects are stale:
+        keeping them would freeze the watermark (and their ack would raise
+        ChannelInvalidStateError against the dead underlay channel).
+        """
+        async with self._lock:
+            self._messages.clear()
+            self._settled.clear()
+            self._next_tag = 1
+
+    async def _flush(self) -> None:
+        # Walk the contiguous run first; state is only discarded once the
+        # ack has actually succeeded, so a failed ack leaves genuinely
+        # completed messages settled for the flusher to retry (or for
+        # reset() to clear after a reconnect).
+        end = self._next_tag
+        last = None
+        while end in self._settled:
+            last = self._messages.get(end, last)
+            end += 1
+        if end == self._next_tag:
+            return
+        if last is not None:
+            await last.ack(multiple=True)
+        for tag in range(self._next_tag, end):
+            self._settled.discard(tag)
+            self._messages.pop(tag, None)
+        self._next_tag = end
+
+
+async def _ack_flusher(batcher: _AckBatcher) -> None:
+    while True:
+        await asyncio.sleep(ACK_FLUSH_INTERVAL_SEC)
+        try:
+            await batcher.flush()
+        except Exception as exc:  # noqa: BLE001 — the flusher must outlive reconnects
+            logger.exception("Ack flush failed (will retry): %s", exc)
+
+
+_BYTES_TYPES = (bytes, bytearray)
+
+
+def _normalize_headers(headers: Dict[str, Any] | None) -> Dict[str, str]:
+    if not headers:
+        return {}
+    items = headers.items()
+    # OTel carriers injected by our producers are already str->str; skip the
+    # rebuild entirely in that common case.
+    if all(isinstance(k, str) and isinstance(v, str) for k, v in items):
+        return headers
+    return {
+        (k.decode() if isinstance(k, _BYTES_TYPES) else str(k)): (
+            v.decode(errors="ignore") if isinstance(v, _BYTES_TYPES) else str(v)
+        )
+        for k, v in items
+    }
+
+
+async def _handle(
+    message: aio_pika.abc.AbstractIncomingMessage,
+    http_client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    queue_name: str,
+    ack_batcher: _AckBatcher,
+) -> None:
+    async with semaphore:
+        headers = _normalize_headers(dict(message.headers or {}))
+        context = None
+        links = None
+        compact = headers.get(TRACE_CTX_HEADER)
+        link = _producer_link(compact) if compact else None
+        if link is not None:
+            links = [link]
+        else:
+            context = _PROPAGATOR.extract(headers)
         with tracer.start_as_current_span(
             name="rabbitmq.process",
             context=context,
             kind=SpanKind.CONSUMER,
+            links=links,
         ) as span:
             span.set_attribute("messaging.system", "rabbitmq")
             span.set_attribute("messaging.destination", queue_name)
             span.set_attribute("messaging.operation", "process")
 
             try:
-                payload = json.loads(body.decode("utf-8"))
-                message = payload.get("message", "")
-                logger.info("Processing message length=%d", len(message))
+                payload = orjson.loads(message.body)
+                text = payload.get("message", "")
+                logger.info("Processing message length=%d", len(text))
 
                 # Call .NET analyze
-                with httpx.Client(base_url=dotnet_url, timeout=5.0) as client:
-                    resp = client.post("/analyze", json={"text": message})
-                    resp.raise_for_status()
-                    analysis = resp.json()
+                resp = await http_client.post("/analyze", json={"text": text})
+                resp.raise_for_status()
+                analysis = orjson.loads(resp.content)
                 logger.info("Analyze result: %s", analysis)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                await ack_batcher.done(message)
             except Exception as exc:  # noqa: BLE001
                 logger.exception("Processing failed: %s", exc)
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                await message.nack(requeue=False)
+                await ack_batcher.done(message, already_settled=True)
+
+
+async def main() -> None:
+    rabbit_host = os.getenv("RABBITMQ_HOST", "localhost")
+    queue_name = os.getenv("RABBITMQ_QUEUE", "chat-jobs")
+    dotnet_url = os.getenv("DOTNET_SERVICE_URL", "http://localhost:8080")
+
+    logger.info("Worker connecting to RabbitMQ host=%s queue=%s", rabbit_host, queue_name)
+
+    shards = int(os.getenv("RABBITMQ_QUEUE_SHARDS", "4"))
+
+    connection = await aio_pika.connect_robust(host=rabbit_host)
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=MAX_CONCURRENCY)
+
+    # Mirror the producer topology: a consistent-hash exchange feeding one
+    # durable queue per shard, consumed concurrently from this process.
+    exchange = await channel.declare_exchange(
+        f"{queue_name}-ch", aio_pika.ExchangeType.X_CONSISTENT_HASH, durable=True
+    )
+    queues = []
+    for i in range(shards):
+        queue = await channel.declare_queue(f"{queue_name}.{i}", durable=True)
+        # For x-consistent-hash the binding key is the shard's weight.
+        await queue.bind(exchange, routing_key="1")
+        queues.append(queue)
+
+    # One shared client for the lifetime of the worker so connections to the
+    # .NET service are kept alive across messages.
+    http_client = httpx.AsyncClient(base_url=dotnet_url, timeout=5.0)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    ack_batcher = _AckBatcher(channel)
+    flusher = asyncio.create_task(_ack_flusher(ack_batcher))
+
+    async def on_channel_reopen(*_: Any) -> None:
+        logger.warning("Channel reopened after reconnect; resetting ack batcher")
+        await ack_batcher.reset()
+
+    # Robust channels re-open after a broker reconnect and delivery tags
+    # restart at 1, so pending batcher state must be dropped with them.
+    channel.reopen_callbacks.add(on_channel_reopen)
+
+    # The loop only holds weak references to tasks, so keep handlers alive in
+    # a set until they finish; the done-callback also surfaces any exception
+    # that escapes _handle (e.g. its own nack failing).
+    handler_tasks: set[asyncio.Task] = set()
+
+    def on_handler_done(task: asyncio.Task) -> None:
+        handler_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Message handler task failed: %s", task.exception())
+
+    async def on_message(message: aio_pika.abc.AbstractIncomingMessage) -> None:
+        # Up to MAX_CONCURRENCY messages are processed concurrently on the
+        # event loop; the work is pure I/O (await the .NET response).
+        task = asyncio.create_task(
+            _handle(message, http_client, semaphore, queue_name, ack_batcher)
+        )
+        handler_tasks.add(task)
+        task.add_done_callback(on_handler_done)
 
-    channel.basic_consume(queue=queue_name, on_message_callback=on_message)
     try:
-        logger.info("Worker started consuming")
-        channel.start_consuming()
-    except KeyboardInterrupt:
+        for queue in queues:
+            await queue.consume(on_message)
+        logger.info("Worker started consuming %d shard queue(s)", shards)
+        await asyncio.Future()
+    except asyncio.CancelledError:
         logger.info("Worker interrupted, closing connection...")
     finally:
-        channel.close()
-        connection.close()
+        flusher.cancel()
+        await ack_batcher.flush()
+        await http_client.aclose()
+        await channel.close()
+        await connection.close()
 
 
 if __name__ == "__main__":
-    main()
-
-
+    uvloop.install()
+    asyncio.run(main())